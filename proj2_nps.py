@@ -3,17 +3,95 @@
 ##### Uniqname: qifanw
 #################################
 
-from bs4 import BeautifulSoup
-import requests
-import json
+from lxml import etree
+from lxml import html as lxml_html
+from requests.adapters import HTTPAdapter
+from requests_cache import CachedSession, DO_NOT_CACHE, NEVER_EXPIRE
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
 import secrets # file that contains your API key
 import sys
+import re
+from html import unescape
+import gzip
+from dataclasses import dataclass
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
 
 
-CACHE_FILENAME = 'national_park_cash.json'
+CACHE_FILENAME = 'national_park_cash.db'
+HTTP_CACHE_FILENAME = 'national_park_cash_http.sqlite'
 CACHE_DICT = {}
+# site_url -> (category, name, address, zipcode, phone), kept in its own
+# table of the cache file so cache hits skip parsing the page
+PARSED_SITE_CACHE = {}
 API_key = secrets.API_key
 
+# one shared session so requests to the same host reuse pooled
+# keep-alive connections instead of a new TCP/TLS handshake each time.
+# MapQuest responses are also cached by the session itself; nps.gov
+# pages go through CACHE_DICT instead and are never cached here.
+SESSION = CachedSession(
+    HTTP_CACHE_FILENAME,
+    backend='sqlite',
+    expire_after=DO_NOT_CACHE,
+    urls_expire_after={'*.mapquestapi.com': NEVER_EXPIRE},
+    ignored_parameters=['key'],
+)
+SESSION.headers['Accept-Encoding'] = 'gzip, deflate'
+SESSION.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
+SESSION.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=32))
+
+# background pool for prefetching MapQuest results while the user reads
+EXECUTOR = ThreadPoolExecutor(max_workers=10)
+# seconds to wait on MapQuest, so exiting never hangs on a prefetch
+MAPQUEST_TIMEOUT = 10
+
+# the state index page is pull-parsed in chunks until this list ends
+STATE_LIST_CLASS = 'dropdown-menu SearchBar-keywordSearch'
+STATE_PAGE_CHUNK_SIZE = 1 << 16
+
+# state pages are read with compiled XPath straight from the lxml tree
+PARK_LINKS_XPATH = etree.XPath("//ul[@id='list_parks']/li/h3/a/@href")
+
+# site pages are server-rendered with a fixed layout, so the six fields
+# are first tried with regexes: one finding the opening tag and one
+# requiring plain text up to its closing tag. Any miss falls back to one
+# walk over the lxml tree looking for these (tag, class token) and
+# (tag, itemprop) pairs. Like that walk, class matches any one token of
+# the attribute while itemprop must match the whole value.
+def _site_field_regexes(tag, attr, value):
+    if attr == 'class':
+        value = rf'(?:[^"]*\s)?{value}(?:\s[^"]*)?'
+    start = re.compile(rf'<{tag}\s(?:[^>]*\s)?{attr}="{value}"[^>]*>')
+    text = re.compile(rf'([^<]*)</{tag}\s*>')
+    return start, text
+
+SITE_FIELD_REGEXES = (
+    _site_field_regexes('a', 'class', 'Hero-title'),
+    _site_field_regexes('span', 'class', 'Hero-designation'),
+    _site_field_regexes('span', 'itemprop', 'addressLocality'),
+    _site_field_regexes('span', 'itemprop', 'addressRegion'),
+    _site_field_regexes('span', 'class', 'postal-code'),
+    _site_field_regexes('span', 'itemprop', 'telephone'),
+)
+SITE_FIELD_CLASSES = {
+    ('a', 'Hero-title'): 'name',
+    ('span', 'Hero-designation'): 'category',
+    ('span', 'postal-code'): 'zipcode',
+}
+SITE_FIELD_ITEMPROPS = {
+    ('span', 'addressLocality'): 'city',
+    ('span', 'addressRegion'): 'state',
+    ('span', 'telephone'): 'phone',
+}
+SITE_FIELD_COUNT = len(SITE_FIELD_CLASSES) + len(SITE_FIELD_ITEMPROPS)
+
+@dataclass(slots=True, frozen=True)
 class NationalSite:
     '''a national site
 
@@ -35,61 +113,148 @@ class NationalSite:
     phone: string
         the phone of a national site (e.g. '(616) 319-7906', '307-344-7381')
     '''
-    def __init__(self, category, name, address, zipcode, phone):
-        self.category = category
-        self.name = name
-        self.address = address
-        self.zipcode = zipcode
-        self.phone = phone
+    category: str
+    name: str
+    address: str
+    zipcode: str
+    phone: str
 
     def info(self):
         return f"{self.name} ({self.category}): {self.address} {self.zipcode}"
 
-def open_cache():
-    ''' Opens the cache file if it exists and loads the JSON into
-    the CACHE_DICT dictionary.
-    if the cache file doesn't exist, creates a new cache dictionary
+class SQLiteCache(MutableMapping):
+    '''a dict-like cache stored in one table of a SQLite file
+
+    Each value is saved as gzip-compressed JSON as soon as it is set,
+    and only the rows that are looked up are read back from disk.
+    The connection is shared by the threads that fetch pages, so every
+    query runs under a lock.
+
+    Instance Attributes
+    -------------------
+    table: string
+        the name of the table holding the cache (e.g. 'cache')
+
+    connection: sqlite3.Connection
+        the connection to the cache file
+    '''
+    def __init__(self, filename, table):
+        self.table = table
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, val BLOB)')
+            self.connection.commit()
+
+    def __contains__(self, key):
+        with self._lock:
+            row = self.connection.execute(
+                f'SELECT 1 FROM {self.table} WHERE key = ?', (key,)).fetchone()
+        return row is not None
+
+    def __getitem__(self, key):
+        with self._lock:
+            row = self.connection.execute(
+                f'SELECT val FROM {self.table} WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return _json.loads(gzip.decompress(row[0]))
+
+    def __setitem__(self, key, value):
+        val = gzip.compress(_dumps(value), compresslevel=1)
+        with self._lock:
+            self.connection.execute(
+                f'INSERT OR REPLACE INTO {self.table} (key, val) VALUES (?, ?)', (key, val))
+            self.connection.commit()
+
+    def __delitem__(self, key):
+        with self._lock:
+            cursor = self.connection.execute(
+                f'DELETE FROM {self.table} WHERE key = ?', (key,))
+            self.connection.commit()
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def __iter__(self):
+        with self._lock:
+            keys = [row[0] for row in self.connection.execute(f'SELECT key FROM {self.table}')]
+        return iter(keys)
+
+    def __len__(self):
+        with self._lock:
+            return self.connection.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+def _dumps(obj):
+    ''' Serializes obj to JSON bytes with whichever json module is loaded
     
     Parameters
     ----------
-    None
+    obj: dict
+        The object to serialize
     
     Returns
     -------
-    The opened cache: dict
+    bytes
+        the UTF-8 encoded JSON
     '''
-    try:
-        cache_file = open(CACHE_FILENAME, 'r')
-        cache_contents = cache_file.read()
-        cache_dict = json.loads(cache_contents)
-        cache_file.close()
-    except:
-        cache_dict = {}
-    return cache_dict
-
-def save_cache(cache_dict):
-    ''' Saves the current state of the cache to disk
+    dumped = _json.dumps(obj)
+    if isinstance(dumped, str):
+        # stdlib json fallback returns str, orjson returns bytes
+        dumped = dumped.encode('utf-8')
+    return dumped
+
+def open_cache(table='cache'):
+    ''' Opens a table of the SQLite cache file, creating the file and
+    the table if they don't exist. Rows are only read when looked up.
     
     Parameters
     ----------
-    cache_dict: dict
-        The dictionary to save
+    table: string
+        The name of the cache table
     
     Returns
     -------
-    None
+    The opened cache: SQLiteCache
     '''
-    dumped_json_cache = json.dumps(cache_dict)
-    fw = open(CACHE_FILENAME,"a")
-    fw.write(dumped_json_cache)
-    fw.close()
+    return SQLiteCache(CACHE_FILENAME, table)
+
+def _iter_state_links(html_text):
+    ''' Pull-parse the nps.gov index page and yield the state links in
+    its state dropdown list, stopping as soon as the list has ended.
+    Every finished <li> and <ul> outside the list is cleared and removed
+    along with its earlier siblings, so the part of the page already
+    read does not stay in memory.
 
-def construct_unique_key(baseurl, params):
-    uniq_key = baseurl
-    for k in params.keys():
-        uniq_key = uniq_key + '_' + k + '_' + str(params[k])
-    return uniq_key
+    Parameters
+    ----------
+    html_text: string
+        The HTML of "https://www.nps.gov/index.htm"
 
+    Returns
+    -------
+    generator
+        (state path, state name) tuples
+        e.g. ('/state/mi/index.htm', 'Michigan')
+    '''
+    parser = etree.HTMLPullParser(events=('end',), tag=('li', 'ul'))
+    for start in range(0, len(html_text), STATE_PAGE_CHUNK_SIZE):
+        parser.feed(html_text[start:start + STATE_PAGE_CHUNK_SIZE])
+        for _, element in parser.read_events():
+            if element.tag == 'ul' and element.get('class') == STATE_LIST_CLASS:
+                return
+            parent = element.getparent()
+            if element.tag == 'li' and parent is not None and parent.get('class') == STATE_LIST_CLASS:
+                course_link_tag = element.find('.//a')
+                yield course_link_tag.get('href'), ''.join(element.itertext()).strip()
+            elif any(ul.get('class') == STATE_LIST_CLASS for ul in element.iterancestors('ul')):
+                # nested inside a state entry that has not been read yet
+                continue
+            element.clear()
+            while element.getprevious() is not None:
+                del parent[0]
 
 def build_state_url_dict():
     ''' Make a dictionary that maps state name to state page url from "https://www.nps.gov"
@@ -105,29 +270,102 @@ def build_state_url_dict():
         e.g. {'michigan':'https://www.nps.gov/state/mi/index.htm', ...}
     '''
     base_url = "https://www.nps.gov/index.htm"
-    if base_url in CACHE_DICT.keys():
+    if base_url in CACHE_DICT:
         print("Using Cache")
-        soup = BeautifulSoup(CACHE_DICT[base_url], 'html.parser')
+        html_text = CACHE_DICT[base_url]
     else:
         print("Fetching")
-        response = requests.get(base_url)
-        soup = BeautifulSoup(response.text, 'html.parser')
+        response = SESSION.get(base_url)
+        html_text = response.text
         CACHE_DICT[base_url] = response.text
-        save_cache(CACHE_DICT)
 
     state_dict = {}
-    course_listing_parent = soup.find('ul', class_='dropdown-menu SearchBar-keywordSearch')
-    course_listing_divs = course_listing_parent.find_all('li', recursive=False)
-    for course_listing_div in course_listing_divs:
-        course_link_tag = course_listing_div.find('a')
-        state_path = course_link_tag['href']
-        state_name = course_listing_div.text.strip()
+    for state_path, state_name in _iter_state_links(html_text):
         each_state_url = 'https://www.nps.gov' + state_path
         state_name = state_name.lower()
         state_dict[state_name] = each_state_url
     
     return state_dict
 
+def _regex_site_fields(html_text):
+    '''Extract the fields of a national site page with SITE_FIELD_REGEXES.
+    
+    Parameters
+    ----------
+    html_text: string
+        The HTML of a national site page in nps.gov
+    
+    Returns
+    -------
+    tuple
+        (category, name, address, zipcode, phone), or None if any
+        field is missing or is not plain text
+    '''
+    values = []
+    for start_regex, text_regex in SITE_FIELD_REGEXES:
+        start = start_regex.search(html_text)
+        if start is None:
+            return None
+        text = text_regex.match(html_text, start.end())
+        if text is None:
+            return None
+        values.append(unescape(text.group(1)).strip())
+    name, category, city, state, zipcode, phone = values
+    return category, name, city + ', ' + state, zipcode, phone
+
+def _tree_site_fields(html_text):
+    '''Extract the fields of a national site page from its lxml tree,
+    walking its <a> and <span> tags once and stopping as soon as every
+    field has been found. The first tag matching a field wins.
+    
+    Parameters
+    ----------
+    html_text: string
+        The HTML of a national site page in nps.gov
+    
+    Returns
+    -------
+    tuple
+        (category, name, address, zipcode, phone)
+    '''
+    tree = lxml_html.fromstring(html_text)
+    found = {}
+    for element in tree.iter('a', 'span'):
+        tag = element.tag
+        fields = [SITE_FIELD_CLASSES.get((tag, token))
+                  for token in element.get('class', '').split()]
+        fields.append(SITE_FIELD_ITEMPROPS.get((tag, element.get('itemprop'))))
+        for field in fields:
+            if field is not None and field not in found:
+                found[field] = ''.join(element.itertext()).strip()
+        if len(found) == SITE_FIELD_COUNT:
+            break
+    address = found.get('city', '') + ', ' + found.get('state', '')
+    return (found.get('category', ''), found.get('name', ''), address,
+            found.get('zipcode', ''), found.get('phone', ''))
+
+def _parse_site_page(site_url, html_text):
+    '''Make a national site instance from the HTML of its page and
+    remember its fields in PARSED_SITE_CACHE.
+    
+    Parameters
+    ----------
+    site_url: string
+        The URL for a national site page in nps.gov
+    html_text: string
+        The HTML of that page
+    
+    Returns
+    -------
+    instance
+        a national site instance
+    '''
+    fields = _regex_site_fields(html_text)
+    if fields is None:
+        fields = _tree_site_fields(html_text)
+    PARSED_SITE_CACHE[site_url] = fields
+    return NationalSite(*fields)
+
 def get_site_instance(site_url):
     '''Make an instances from a national site URL.
     
@@ -141,24 +379,20 @@ def get_site_instance(site_url):
     instance
         a national site instance
     '''
-    if site_url in CACHE_DICT.keys():
+    if site_url in PARSED_SITE_CACHE:
         print("Using Cache")
-        soup = BeautifulSoup(CACHE_DICT[site_url], 'html.parser')
+        return NationalSite(*PARSED_SITE_CACHE[site_url])
+    elif site_url in CACHE_DICT:
+        print("Using Cache")
+        html_text = CACHE_DICT[site_url]
     else:
         print("Fetching")
-        response = requests.get(site_url)
+        response = SESSION.get(site_url)
         CACHE_DICT[site_url] = response.text
-        save_cache(CACHE_DICT)
-        soup = BeautifulSoup(response.text, 'html.parser')
-
-    name = soup.find('a', class_='Hero-title').text.strip()
-    category = soup.find('span', class_='Hero-designation').text.strip()
-    address = soup.find('span', itemprop='addressLocality').text.strip() + ', ' + soup.find('span', itemprop='addressRegion').text.strip()
-    zipcode = soup.find('span', class_='postal-code').text.strip()
-    phone = soup.find('span', itemprop='telephone').text.strip()
+        html_text = response.text
+
     # return category, my_type, address
-    site_instance = NationalSite(category, name, address, zipcode, phone)
-    return site_instance
+    return _parse_site_page(site_url, html_text)
 
 def get_sites_for_state(state_url):
     '''Make a list of national site instances from a state URL.
@@ -174,25 +408,45 @@ def get_sites_for_state(state_url):
         a list of national site instances
     '''
     instance_list = []
-    response = requests.get(state_url)
-    soup = BeautifulSoup(response.text, 'html.parser')
-    # state_name = soup.find('h1', class_='page-title').text
-    course_listing_parent = soup.find('ul', id='list_parks')
-    course_listing_divs = course_listing_parent.find_all('li', recursive=False)
-    for course_listing_div in course_listing_divs:
-        site_url_detail = course_listing_div.find('h3').find('a')['href']
+    response = SESSION.get(state_url)
+    tree = lxml_html.fromstring(response.text)
+    site_urls = []
+    for site_url_detail in PARK_LINKS_XPATH(tree):
         site_url = 'https://www.nps.gov' + site_url_detail + 'index.htm'
-        instance_list.append(get_site_instance(site_url))
+        site_urls.append(site_url)
+
+    # fetch the uncached site pages concurrently and parse them as they
+    # arrive; the rest are read from the cache by get_site_instance
+    uncached_urls = [site_url for site_url in site_urls
+                     if site_url not in PARSED_SITE_CACHE and site_url not in CACHE_DICT]
+    fetched_sites = {}
+    if uncached_urls:
+        for site_url in uncached_urls:
+            print("Fetching")
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            responses = executor.map(SESSION.get, uncached_urls)
+            for site_url, site_response in zip(uncached_urls, responses):
+                CACHE_DICT[site_url] = site_response.text
+                fetched_sites[site_url] = _parse_site_page(site_url, site_response.text)
+
+    for site_url in site_urls:
+        if site_url in fetched_sites:
+            instance_list.append(fetched_sites[site_url])
+        else:
+            instance_list.append(get_site_instance(site_url))
     return instance_list
 
 
-def get_nearby_places(site_object):
+def get_nearby_places(site_object, verbose=True):
     '''Obtain API data from MapQuest API.
     
     Parameters
     ----------
     site_object: object
         an instance of a national site
+    verbose: bool
+        whether to print "Fetching"/"Using Cache"; False for background
+        prefetches so they don't write over the prompt
     
     Returns
     -------
@@ -209,22 +463,16 @@ def get_nearby_places(site_object):
         "ambiguities": "ignore",
         "outFormat": "json"
     }
-    uniq_key = construct_unique_key(baseurl, params)
-    if uniq_key in CACHE_DICT.keys():
-        print("Using Cache")
-        response = CACHE_DICT[uniq_key]
-    else:
-        print("Fetching")
-        response = requests.get(baseurl, params).json()
-        CACHE_DICT[uniq_key] = response
-        save_cache(CACHE_DICT)
+    response = SESSION.get(baseurl, params=params, timeout=MAPQUEST_TIMEOUT)
+    if verbose:
+        print("Using Cache" if response.from_cache else "Fetching")
 
-    return response
+    return response.json()
     # response = requests.get(baseurl, params)
     # return response.text
     # 
 
-def print_nearby_places(site_object):
+def print_nearby_places(site_object, prefetch=None):
     '''
     print the nearby places
 
@@ -232,15 +480,21 @@ def print_nearby_places(site_object):
     ----------
     site_object: object
         an instance of a national site
+    prefetch: concurrent.futures.Future
+        a background get_nearby_places call for site_object to wait on
+        instead of sending a new request, or None
     
     Returns
     -------
     None
     '''
-    nearby_places_list = get_nearby_places(site_object)["searchResults"]
-    print("---------------")
-    print(f"Places near {site_object.name}")
-    print("---------------")
+    if prefetch is None:
+        nearby_places = get_nearby_places(site_object)
+    else:
+        print("Using Cache" if prefetch.done() else "Fetching")
+        nearby_places = prefetch.result()
+    nearby_places_list = nearby_places["searchResults"]
+    lines = ["---------------", f"Places near {site_object.name}", "---------------"]
     for nearby_place in nearby_places_list:
         nearby_place = nearby_place['fields']
         name = nearby_place['name']
@@ -254,44 +508,55 @@ def print_nearby_places(site_object):
         if city == '':
             city = "no city"
         info = f"- {name} ({category}): {address}, {city}"
-        print(info)
+        lines.append(info)
+    sys.stdout.write("\n".join(lines) + "\n")
 
 
 if __name__ == "__main__":
     # print(build_state_url_dict())
     # print(get_sites_for_state('https://www.nps.gov/state/az/index.htm')[1].info())
     CACHE_DICT = open_cache()
+    PARSED_SITE_CACHE = open_cache('parsed_sites')
     states_dict = build_state_url_dict()
     while True:
         search_state = input('Enter a State name (e.g., Michigan, michigan) or "exit":  \n')
-        if search_state.lower() in states_dict:
-            state_url = states_dict[search_state.lower()]
+        state_key = search_state.strip().lower()
+        if state_key in states_dict:
+            state_url = states_dict[state_key]
             instance_list = get_sites_for_state(state_url)
-            print("-------------------")
-            print(f"List of national sites in {search_state}")
-            print("-------------------")
+            lines = ["-------------------", f"List of national sites in {search_state}", "-------------------"]
             for index, site in enumerate(instance_list[:10]):
                 site_info = f"[{index+1}] {site.info()}"
-                print(site_info)
+                lines.append(site_info)
+            sys.stdout.write("\n".join(lines) + "\n")
+            # warm the cache for the listed sites before the user picks one
+            prefetches = {}
+            for index, site in enumerate(instance_list[:10]):
+                prefetches[index] = EXECUTOR.submit(get_nearby_places, site, verbose=False)
 
             while True:
                 enter_num = input('Choose the number for detail search or enter "exit" or "back": \n')
-                if enter_num.lower() == 'exit':
+                command = enter_num.strip().lower()
+                if command == 'exit':
+                    EXECUTOR.shutdown(wait=False, cancel_futures=True)
                     sys.exit(0)
-                elif enter_num.lower() == 'back':
+                elif command == 'back':
+                    for prefetch in prefetches.values():
+                        prefetch.cancel()
                     break
                 try:
-                    num = int(enter_num)
+                    num = int(command)
                     if 1 <= num <= len(instance_list):
                         # print("-------------------")
                         # print(f"Places near {instance_list[num-1]}")
                         # print("-------------------")
-                        print_nearby_places(instance_list[num-1])
+                        print_nearby_places(instance_list[num-1], prefetches.get(num-1))
                     else:
                         print("[Error] Invalid input")
                 except ValueError:
                     print("[Error] Invalid input")
-        elif search_state.lower() == 'exit':
+        elif state_key == 'exit':
+            EXECUTOR.shutdown(wait=False, cancel_futures=True)
             sys.exit(0)
         else:
             print("[Error] Enter proper state name")